@@ -1,13 +1,92 @@
 import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from bs4 import BeautifulSoup
 import urllib.parse
 import os
+import shutil
 import yaml
 import struct 
 import json
+import sys
+from array import array
+from dataclasses import dataclass
 from conversions import rgb_to_hex, rgb_float_to_int
 
+# Use the libyaml bindings when pyyaml was built with them.
+try:
+    from yaml import CSafeDumper as YamlDumper, CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeDumper as YamlDumper, SafeLoader as YamlLoader
+
+# The compiled chunk scan needs numba; fall back to the pure python parser without it.
+try:
+    from _ase_jit import COLOR_MODES, scan_color_chunks
+except ImportError:
+    scan_color_chunks = None
+
+# Precompiled structs for the big-endian values in an ase file.
+_U16BE = struct.Struct(">H")
+_U32BE = struct.Struct(">I")
+_HEADER = struct.Struct("!HHI")
+
+# Swatch types by the index stored in the last byte of a color entry.
+_SWATCH_TYPES = ('Global', 'Spot', 'Process')
+
+# Size in bytes of the big-endian float values of each color mode.
+_COLOR_VALUE_SIZES = {b'RGB': 12, b'Gray': 4, b'CMYK': 16, b'LAB': 12}
+
+# Color mode field and value size of RGB colors, the only mode used by Benjamin Moore.
+_RGB_MODE = b'RGB '
+_RGB_VALUE_SIZE = 12
+
+# The float arrays are native-endian, ase values are big-endian.
+_SWAP_FLOATS = sys.byteorder == 'little'
+
+def _read_floats(mv, offset, size):
+    """
+    Reads the big-endian floats in size bytes at offset into a float array,
+    without creating a python float for each value.
+    """
+    values = array('f')
+    values.frombytes(mv[offset:offset + size])
+    if _SWAP_FLOATS:
+        values.byteswap()
+    return values
+
+class _NotAllRgb(Exception):
+    """
+    Raised by the RGB only parser when it finds a color in another mode.
+    """
+
+@dataclass(slots=True)
+class AseColor:
+    """
+    A color entry parsed from an ase file.
+    """
+    name: str
+    swatch_type: str
+    mode: str
+    values: array
+    # set by BMColors.enrich_parsed_colors for RGB colors
+    rgb: dict | None = None
+    hex: str | None = None
+
+    def to_dict(self):
+        """
+        Returns the color in the nested format written to the yaml and json output.
+        """
+        data = {'mode': self.mode, 'values': self.values.tolist()}
+        if self.rgb is not None:
+            data['rgb'] = self.rgb
+            data['hex'] = self.hex
+        return {'name': self.name, 'swatch_type': self.swatch_type, 'data': data}
+
+# Write colors in their nested format with our dumper as well as the default pyyaml dumpers
+for _dumper in (YamlDumper, yaml.SafeDumper, yaml.Dumper):
+    yaml.add_representer(AseColor, lambda dumper, color: dumper.represent_dict(color.to_dict()), Dumper=_dumper)
+
 class BMColors:
 
     # Default location of the Benjamin Moore color collections containing ase files.
@@ -19,6 +98,9 @@ class BMColors:
 
     default_output_filename_json = "benjaminmoore-colors.json"
 
+    # Number of .ase files to download concurrently.
+    default_download_workers = 8
+
     def __init__(self, options={}):
         # TODO: Fill in the comments for the constructor.
         self.options = options
@@ -28,9 +110,24 @@ class BMColors:
 
         # set the workspace directory to the default if it is not set in the options
         self.workspace_dir = options.get('workspace_dir', 'workspace')
+        self._workspace_ready = False
+
+        # set the number of download workers to the default if it is not set in the options
+        self.download_workers = options.get('download_workers', self.default_download_workers)
+
+        # shared session so connections are reused across the scrape and all downloads
+        self.session = requests.Session()
+
+        # keep a pooled connection per download worker, the default pool only holds 10
+        adapter = HTTPAdapter(pool_maxsize=self.download_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
         self.collections_data = []
 
+        # index of self.collections_data keyed by file_name
+        self._collections_by_file = {}
+
         self.parsed_colors = {}
     
 
@@ -48,16 +145,22 @@ class BMColors:
         print("Scraping: ", url)
 
         # Send a GET request to the website
-        response = requests.get(url)
+        response = self.session.get(url)
 
         # Create a BeautifulSoup object to parse the HTML content
-        soup = BeautifulSoup(response.content, "html.parser")
+        soup = BeautifulSoup(response.content, "lxml")
 
-        # Find all <a> tags that end in ".ase"
-        ase_links = soup.find_all("a", href=lambda href: href and href.endswith(".ase"))
+        # Find all <a> tags with an href that ends in ".ase"
+        ase_links = soup.select('a[href$=".ase"]')
 
         print(f"Found {len(ase_links)} links to .ase files.")
 
+        # The scrape replaces the previous collections, so collections removed from the site are dropped.
+        # Only the ETags of the previous downloads are carried over.
+        previous_collections = self._collections_by_file
+        self.collections_data = []
+        self._collections_by_file = {}
+
         # Save each collection name and the link to its .ase file
         for link in ase_links:
             file_url = urllib.parse.urljoin(url, link["href"])
@@ -66,20 +169,22 @@ class BMColors:
             file_name = link["href"].split("/")[-1]  # Extract the file name from the URL
             
             # check if the file_name already exists in self.collections_data
-            # if it does, then append overwrite the entry in the list, otherwise append
-            collection_exists = False
-            for collection in self.collections_data:
-                if collection['file_name'] == file_name:
-                    collection['collection_name'] = collection_name
-                    collection['file_url'] = file_url
-                    collection_exists = True
-                    break
-            if not collection_exists:
-                self.collections_data.append({
+            # if it does, then overwrite the entry in the list, otherwise append
+            collection = self._collections_by_file.get(file_name)
+            if collection is None:
+                collection = {
                     "collection_name": collection_name,
                     "file_name": file_name,
                     "file_url": file_url
-                })
+                }
+                previous_collection = previous_collections.get(file_name)
+                if previous_collection is not None and previous_collection.get('etag'):
+                    collection['etag'] = previous_collection['etag']
+                self.collections_data.append(collection)
+                self._collections_by_file[file_name] = collection
+            else:
+                collection['collection_name'] = collection_name
+                collection['file_url'] = file_url
 
         print(f"Found {len(self.collections_data)} collections.")
         # write the collections data to the workspace
@@ -96,18 +201,61 @@ class BMColors:
 
         print(f"Downloading {len(self.collections_data)} .ase files.")
 
-        # Download each .ase file
-        for collection in self.collections_data:
-            print("Downloading:", collection['file_name'])
-
-            # Send a GET request to download the file
-            file_response = requests.get(collection['file_url'])
-            
-            # Save the file to the workspace folder
-            with open(os.path.join(self.workspace_dir, collection['file_name']), "wb") as file:
-                file.write(file_response.content)
+        # Download the .ase files concurrently
+        try:
+            with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+                # consume the results so any download errors are raised here
+                list(executor.map(self._download_ase_file, self.collections_data))
+        finally:
+            # persist the ETags of the downloaded files, and drop those of failed downloads
+            self.save_collections_data_to_workspace()
         
         print("Download complete.")
+
+    def _download_ase_file(self, collection):
+        """
+        Downloads the ase file for a single collection into the workspace.
+        :param collection: The collection entry to download.
+        """
+        file_path = os.path.join(self.workspace_dir, collection['file_name'])
+
+        # Take the saved ETag off the collection so a failed download never keeps a stale one
+        etag = collection.pop('etag', None)
+
+        # only ask for the file if it has changed since the last download
+        headers = {}
+        if etag and os.path.exists(file_path):
+            headers['If-None-Match'] = etag
+
+        # Send a GET request to download the file
+        with self.session.get(collection['file_url'], headers=headers, stream=True) as file_response:
+            if file_response.status_code == 304:
+                print("Unchanged:", collection['file_name'])
+                collection['etag'] = etag
+                return
+
+            file_response.raise_for_status()
+
+            print("Downloading:", collection['file_name'])
+
+            # Stream the file to a partial file without holding it all in memory, and only
+            # move it into place once it is complete so an interrupted download never
+            # replaces the file
+            part_path = file_path + ".part"
+            try:
+                file_response.raw.decode_content = True
+                with open(part_path, "wb") as file:
+                    shutil.copyfileobj(file_response.raw, file, 64 * 1024)
+            except BaseException:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            os.replace(part_path, file_path)
+
+            # remember the ETag so the next run can skip this file if it is unchanged
+            etag = file_response.headers.get('ETag')
+            if etag:
+                collection['etag'] = etag
     
     def parse_all_ase_files_in_workspace(self):
         """
@@ -116,10 +264,14 @@ class BMColors:
         # prepare the workspace
         self._prepare_workspace()
 
-        # parse all the ase files in the workspace
-        for file_name in os.listdir(self.workspace_dir):
-            if file_name.endswith(".ase"):
-                self.parse_ase_file_by_name(file_name)
+        with os.scandir(self.workspace_dir) as entries:
+            file_paths = [entry.path for entry in entries if entry.name.endswith(".ase") and entry.is_file()]
+
+        # parse all the ase files in the workspace, one process per cpu
+        with ProcessPoolExecutor() as executor:
+            for file_name, this_parsed_colors in executor.map(_parse_ase_file, file_paths):
+                print(f"Parsed {file_name}: found {len(this_parsed_colors)} colors.")
+                self.parsed_colors[file_name] = this_parsed_colors
         
         self.enrich_parsed_colors()
 
@@ -154,10 +306,6 @@ class BMColors:
         # prepare the workspace
         self._prepare_workspace()
         
-        # check if file_path exists
-        if not os.path.exists(file_path):
-            raise Exception(f"File '{file_path}' does not exist.")
-        
         # read in the file into a bytes object
         with open(file_path, "rb") as f:
             ase_data = f.read()
@@ -174,7 +322,8 @@ class BMColors:
 
         return this_parsed_colors
 
-    def parse_ase_data(self, byte_data, debug=False):
+    @staticmethod
+    def parse_ase_data(byte_data, debug=False):
         """
         Parses the ase file and returns a list of color objects.
 
@@ -183,82 +332,186 @@ class BMColors:
             debug (bool, optional): Whether to print debug statements. Defaults to False.
         """
         pointer = 4  # Skip the "ASEF" header
-        major_version, minor_version, num_chunks = struct.unpack_from("!HHI", byte_data, pointer)
+        major_version, minor_version, num_chunks = _HEADER.unpack_from(byte_data, pointer)
 
-        print(f"Major version: {major_version}, Minor version: {minor_version}, Number of chunks: {num_chunks}") if debug else None
+        if debug:
+            print(f"Major version: {major_version}, Minor version: {minor_version}, Number of chunks: {num_chunks}")
         pointer += 8
 
-        colors = []
+        if scan_color_chunks is not None and not debug:
+            return BMColors._parse_ase_colors_jit(byte_data, pointer, num_chunks)
+
+        # view over the file so slices below reference byte_data without copying it
+        mv = memoryview(byte_data)
+
+        # try the RGB only parser first, and fall back to the generic one below for other modes
+        if not debug:
+            try:
+                return BMColors._parse_ase_rgb_colors(mv, pointer, num_chunks)
+            except _NotAllRgb:
+                pass
+
+        # every chunk is at most one color, so allocate the list once and trim it at the end.
+        # A chunk takes at least 6 bytes, which caps the size for a corrupt chunk count.
+        colors = [None] * min(num_chunks, len(mv) // 6)
+        color_count = 0
         for _ in range(num_chunks):
-            print(f"Processing chunk {_}/{num_chunks}. pointer at {pointer}/{len(byte_data)}") if debug else None
-            chunk_type, = struct.unpack_from(">H", byte_data, pointer)
+            if debug:
+                print(f"Processing chunk {_}/{num_chunks}. pointer at {pointer}/{len(byte_data)}")
+            chunk_type, = _U16BE.unpack_from(mv, pointer)
             pointer += 2
 
-            chunk_size, = struct.unpack_from(">I", byte_data, pointer)
+            chunk_size, = _U32BE.unpack_from(mv, pointer)
             pointer += 4
 
+            chunk_start = pointer
             chunk_end = pointer + chunk_size
-            chunk = byte_data[pointer:pointer + chunk_size]
             pointer = chunk_end  # Move to the next chunk no matter what
 
             if chunk_type == 0xc001:  # Palette
-                print(f"Palette chunk... skipping to {chunk_end}") if debug else None
+                if debug:
+                    print(f"Palette chunk... skipping to {chunk_end}")
                 continue
             
             if chunk_type == 0xc002:  # Palette End
-                print(f"Palette end chunk... skipping to {chunk_end}") if debug else None
+                if debug:
+                    print(f"Palette end chunk... skipping to {chunk_end}")
                 continue
 
             if chunk_type == 0x0001:  # Color entry
-                print(f"Processing color... chunk length: {chunk_size}") if debug else None
+                if debug:
+                    print(f"Processing color... chunk length: {chunk_size}")
                 
-                chunk_pointer = 0
-                title_length, = struct.unpack_from(">H", chunk, chunk_pointer)
-                chunk_pointer += 2
+                # All reads below are absolute offsets into mv so no copy of the chunk is made,
+                # so they are checked against the end of the chunk (the same checks as the numba scan)
+                if chunk_end > len(mv):
+                    raise ValueError("ase chunk runs past the end of the file")
+                if chunk_start + 2 > chunk_end:
+                    raise ValueError("ase color entry is too short for its title length")
+                title_length, = _U16BE.unpack_from(mv, chunk_start)
+                if chunk_start + 2 + title_length*2 + 6 > chunk_end:
+                    raise ValueError("ase color entry is too short for its color mode")
                 
-                # Decode the color name
-                title_raw, = struct.unpack_from(f"!{title_length*2}s", chunk, chunk_pointer)
-
-                # title = title_raw.decode('utf-8', 'ignore')
-                title = title_raw.decode("utf-16be").strip('\0')
+                # Decode the color name straight from the view, the NUL terminator is always at the end
+                title = str(mv[chunk_start + 2:chunk_start + 2 + title_length*2], "utf-16be").rstrip('\0')
                 
 
-                print(f"Color '{title}' found.") if debug else None
+                if debug:
+                    print(f"Color '{title}' found.")
 
-                color_data = chunk[2 + title_length*2:]  
+                color_data_start = chunk_start + 2 + title_length*2
 
                 # Decode the color mode
-                color_mode = struct.unpack_from(f"!4s", color_data)[0].strip()
+                color_mode = bytes(mv[color_data_start:color_data_start + 4]).strip()
 
                 # Decode the color values
-                fmt = {b'RGB': '!fff', b'Gray': '!f', b'CMYK': '!ffff', b'LAB': '!fff'}
-                color_values = list(struct.unpack(fmt[color_mode], color_data[4:-2]))
+                value_size = _COLOR_VALUE_SIZES[color_mode]
+                if color_data_start + 4 + value_size + 2 > chunk_end:
+                    raise ValueError("ase color entry is too short for its color values")
+                color_values = _read_floats(mv, color_data_start + 4, value_size)
                 
                 # Decode the color type
-                color_types = ['Global', 'Spot', 'Process']
-                swatch_type_index = struct.unpack(">h", color_data[-2:])[0]
-                swatch_type = color_types[swatch_type_index]
-
-                color = {
-                    'name': title,
-                    'swatch_type': swatch_type,
-                    'data': {
-                        'mode': color_mode.decode('utf-8'),
-                        'values': color_values
-                    }
-                }
-                colors.append(color)
+                # the swatch type is a 16 bit int of 0-2, so only its low byte is read
+                swatch_type = _SWATCH_TYPES[mv[chunk_end - 1]]
+
+                color = AseColor(title, swatch_type, color_mode.decode('utf-8'), color_values)
+                colors[color_count] = color
+                color_count += 1
 
-                print(f"Processed '{color['name']}' - {color['data']['mode']} - {color['data']['values']}") if debug else None
+                if debug:
+                    print(f"Processed '{color.name}' - {color.mode} - {color.values.tolist()}")
         
+        del colors[color_count:]
+        return colors
+
+    @staticmethod
+    def _parse_ase_rgb_colors(mv, pointer, num_chunks):
+        """
+        Parses the color entries of an ase file that only contains RGB colors.
+        Same as the loop in parse_ase_data without the color mode lookup.
+
+        Raises _NotAllRgb if a color is in any other mode.
+
+        Args:
+            mv (memoryview): A view over the bytes of the ase file to parse.
+            pointer (int): The offset of the first chunk.
+            num_chunks (int): The number of chunks in the file.
+        """
+        colors = [None] * min(num_chunks, len(mv) // 6)
+        color_count = 0
+        for _ in range(num_chunks):
+            chunk_type, = _U16BE.unpack_from(mv, pointer)
+            chunk_size, = _U32BE.unpack_from(mv, pointer + 2)
+
+            chunk_start = pointer + 6
+            chunk_end = chunk_start + chunk_size
+            pointer = chunk_end
+
+            if chunk_type != 0x0001:  # Only color entries hold colors
+                continue
+
+            if chunk_end > len(mv):
+                raise ValueError("ase chunk runs past the end of the file")
+            if chunk_start + 2 > chunk_end:
+                raise ValueError("ase color entry is too short for its title length")
+            title_length, = _U16BE.unpack_from(mv, chunk_start)
+            color_data_start = chunk_start + 2 + title_length*2
+            if color_data_start + 6 > chunk_end:
+                raise ValueError("ase color entry is too short for its color mode")
+
+            if mv[color_data_start:color_data_start + 4] != _RGB_MODE:
+                raise _NotAllRgb()
+            if color_data_start + 4 + _RGB_VALUE_SIZE + 2 > chunk_end:
+                raise ValueError("ase color entry is too short for its color values")
+
+            colors[color_count] = AseColor(
+                str(mv[chunk_start + 2:color_data_start], "utf-16be").rstrip('\0'),
+                _SWATCH_TYPES[mv[chunk_end - 1]],
+                'RGB',
+                _read_floats(mv, color_data_start + 4, _RGB_VALUE_SIZE))
+            color_count += 1
+
+        del colors[color_count:]
+        return colors
+
+    @staticmethod
+    def _parse_ase_colors_jit(byte_data, pointer, num_chunks):
+        """
+        Parses the color entries of an ase file using the compiled chunk scan.
+
+        Args:
+            byte_data (bytes): The bytes of the ase file to parse.
+            pointer (int): The offset of the first chunk.
+            num_chunks (int): The number of chunks in the file.
+        """
+        title_offsets, title_lengths, mode_offsets, mode_codes, swatch_indices, values = scan_color_chunks(byte_data, pointer, num_chunks)
+
+        mv = memoryview(byte_data)
+
+        colors = [None] * len(title_offsets)
+        for color_index, (title_offset, title_length, mode_offset, mode_code, swatch_index, color_values) in enumerate(zip(
+                title_offsets, title_lengths, mode_offsets, mode_codes, swatch_indices, values)):
+            if mode_code < 0:
+                raise KeyError(bytes(mv[mode_offset:mode_offset + 4]).strip())
+            color_mode = COLOR_MODES[mode_code]
+
+            title = str(mv[title_offset:title_offset + title_length*2], "utf-16be").rstrip('\0')
+
+            colors[color_index] = AseColor(title, _SWATCH_TYPES[swatch_index], color_mode.decode('utf-8'), color_values)
+
         return colors
 
     def _prepare_workspace(self):
         """
         Prepares the workspace for the scraper.
         """
+        # the workspace only has to be created once per instance
+        if self._workspace_ready:
+            return
+
         # Prepare a workspace folder
-        os.makedirs("workspace", exist_ok=True)
+        os.makedirs(self.workspace_dir, exist_ok=True)
+        self._workspace_ready = True
 
     def save_collections_data_to_workspace(self):
         """
@@ -268,7 +521,7 @@ class BMColors:
         self._prepare_workspace()
         file_name = os.path.join(self.workspace_dir, self.default_collections_filename)
         with open(file_name, "w") as f:
-            yaml.dump(self.collections_data, f)
+            yaml.dump(self.collections_data, f, Dumper=YamlDumper)
         
         print(f"Saved collections url data to '{file_name}'")
 
@@ -281,8 +534,12 @@ class BMColors:
             return
 
         with open(os.path.join(self.workspace_dir, self.default_collections_filename), "r") as f:
-            collections_data = yaml.safe_load(f)
+            collections_data = yaml.load(f, Loader=YamlLoader)
+        # an empty or truncated file loads as None
+        if collections_data is None:
+            collections_data = []
         self.collections_data = collections_data
+        self._collections_by_file = {collection['file_name']: collection for collection in collections_data}
 
     def save_parsed_colors_to_yaml_workspace(self):
         """
@@ -295,7 +552,7 @@ class BMColors:
 
         print(f"Saving parsed colors to '{output_filepath}' ... ", end='')
         with open(output_filepath, "w") as f:
-            yaml.dump(self.parsed_colors, f)
+            yaml.dump(self.parsed_colors, f, Dumper=YamlDumper)
 
         print(f"Saved.")
     
@@ -310,7 +567,7 @@ class BMColors:
 
         print(f"Saving parsed colors to '{output_filepath}' ... ", end='')
         with open(output_filepath, "w") as f:
-            json.dump(self.parsed_colors, f)
+            json.dump(self.parsed_colors, f, default=AseColor.to_dict)
 
         print(f"Saved.")
 
@@ -320,11 +577,22 @@ class BMColors:
         """
         for collection_name, collection_data in self.parsed_colors.items():
             for color in collection_data:
-                if color['data']['mode'] != 'RGB':
+                if color.mode != 'RGB':
                     continue
-                rgb = color['data']['values']
-                color['data']['rgb'] = rgb_float_to_int(rgb)
-                color['data']['hex'] = rgb_to_hex(color['data']['rgb'])
+                color.rgb = rgb_float_to_int(color.values)
+                color.hex = rgb_to_hex(color.rgb)
+
+def _parse_ase_file(file_path):
+    """
+    Reads and parses an ase file. Runs in a worker process of parse_all_ase_files_in_workspace.
+
+    Args:
+        file_path (str): The path to the ase file to parse.
+    """
+    with open(file_path, "rb") as f:
+        ase_data = f.read()
+
+    return os.path.basename(file_path), BMColors.parse_ase_data(ase_data)
 
 def main():
     parser = argparse.ArgumentParser(description='Scrape, download and parse all ase files for Benjamin Moore color collections.')
@@ -336,6 +604,10 @@ def main():
 
     bm_colors = BMColors()
 
+    # load the ETags from previous runs so unchanged files are not downloaded again
+    if not args.parse:
+        bm_colors.load_collections_data_from_workspace()
+
     if args.scrape:
         bm_colors.scrape_collections()
         bm_colors.download_ase_files()
@@ -0,0 +1,138 @@
+from array import array
+
+import numpy as np
+from numba import njit
+
+# Color mode codes returned by the chunk scan. The index is the code.
+COLOR_MODES = (b'RGB', b'Gray', b'CMYK', b'LAB')
+
+# Number of float values stored for each color mode code.
+COLOR_VALUE_COUNTS = (3, 1, 4, 3)
+
+@njit(cache=True)
+def _color_mode_code(buf, offset):
+    """
+    Returns the code of the 4 byte color mode at offset, or -1 if it is not a known mode.
+    """
+    b0, b1, b2, b3 = buf[offset], buf[offset + 1], buf[offset + 2], buf[offset + 3]
+    if b0 == 82 and b1 == 71 and b2 == 66 and b3 == 32:  # "RGB "
+        return 0
+    if b0 == 71 and b1 == 114 and b2 == 97 and b3 == 121:  # "Gray"
+        return 1
+    if b0 == 67 and b1 == 77 and b2 == 89 and b3 == 75:  # "CMYK"
+        return 2
+    if b0 == 76 and b1 == 65 and b2 == 66 and b3 == 32:  # "LAB "
+        return 3
+    return -1
+
+@njit(cache=True)
+def _scan_chunks(buf, pointer, num_chunks):
+    """
+    Walks the chunks of an ase file and records the layout of every color entry.
+
+    Args:
+        buf (ndarray): The bytes of the ase file as a uint8 array.
+        pointer (int): The offset of the first chunk.
+        num_chunks (int): The number of chunks in the file.
+    """
+    title_offsets = np.empty(num_chunks, np.int64)
+    title_lengths = np.empty(num_chunks, np.int64)
+    mode_offsets = np.empty(num_chunks, np.int64)
+    mode_codes = np.empty(num_chunks, np.int64)
+    swatch_indices = np.empty(num_chunks, np.int64)
+
+    # numba does not bounds check, so every read below is checked against the end of the file
+    buf_end = len(buf)
+
+    count = 0
+    for _ in range(num_chunks):
+        if pointer + 6 > buf_end:
+            raise ValueError("ase chunk header runs past the end of the file")
+        chunk_type = (np.int64(buf[pointer]) << 8) | buf[pointer + 1]
+        chunk_size = ((np.int64(buf[pointer + 2]) << 24) | (np.int64(buf[pointer + 3]) << 16)
+                      | (np.int64(buf[pointer + 4]) << 8) | buf[pointer + 5])
+        pointer += 6
+
+        chunk_start = pointer
+        chunk_end = pointer + chunk_size
+        pointer = chunk_end  # Move to the next chunk no matter what
+
+        if chunk_end > buf_end:
+            raise ValueError("ase chunk runs past the end of the file")
+
+        if chunk_type != 0x0001:  # Only color entries are recorded
+            continue
+
+        if chunk_start + 2 > chunk_end:
+            raise ValueError("ase color entry is too short for its title length")
+        title_length = (np.int64(buf[chunk_start]) << 8) | buf[chunk_start + 1]
+        mode_offset = chunk_start + 2 + title_length * 2
+
+        # the color mode and the swatch type have to fit in the chunk
+        if mode_offset + 6 > chunk_end:
+            raise ValueError("ase color entry is too short for its color mode")
+        mode_code = _color_mode_code(buf, mode_offset)
+        if mode_code >= 0 and mode_offset + 6 + COLOR_VALUE_COUNTS[mode_code] * 4 > chunk_end:
+            raise ValueError("ase color entry is too short for its color values")
+
+        title_offsets[count] = chunk_start + 2
+        title_lengths[count] = title_length
+        mode_offsets[count] = mode_offset
+        mode_codes[count] = mode_code
+        swatch_indices[count] = buf[chunk_end - 1]  # the swatch type is 0-2, its low byte is enough
+        count += 1
+
+    return (title_offsets[:count], title_lengths[:count], mode_offsets[:count],
+            mode_codes[:count], swatch_indices[:count])
+
+def _decode_floats(buf, offsets, value_count):
+    """
+    Decodes value_count big-endian floats at each offset in a single gather.
+
+    Args:
+        buf (ndarray): The bytes of the ase file as a uint8 array.
+        offsets (ndarray): The offset of the first float of each row.
+        value_count (int): The number of floats in each row.
+    """
+    byte_indices = offsets[:, None] + np.arange(value_count * 4)
+    return buf[byte_indices].view('>f4').astype(np.float32)
+
+def scan_color_chunks(byte_data, pointer, num_chunks):
+    """
+    Scans the chunks of an ase file with the compiled kernel.
+
+    Returns parallel lists with the title offset, title length (in utf-16 characters),
+    color mode offset, color mode code (an index into COLOR_MODES, or -1), swatch type
+    index and color values (a float array) of every color entry. Entries with an unknown
+    color mode have no color values (None).
+
+    Args:
+        byte_data (bytes): The bytes of the ase file.
+        pointer (int): The offset of the first chunk.
+        num_chunks (int): The number of chunks in the file.
+    """
+    buf = np.frombuffer(byte_data, dtype=np.uint8)
+
+    # every chunk has a 6 byte header, more chunks than that cannot fit in the file
+    if num_chunks > (len(buf) - pointer) // 6:
+        raise ValueError("ase header has more chunks than fit in the file")
+
+    columns = _scan_chunks(buf, pointer, num_chunks)
+    mode_offsets, mode_codes = columns[2], columns[3]
+
+    # decode the color values of all entries with the same color mode at once
+    color_values = [None] * len(mode_codes)
+    for mode_code, value_count in enumerate(COLOR_VALUE_COUNTS):
+        rows = np.flatnonzero(mode_codes == mode_code)
+        if len(rows) == 0:
+            continue
+        values = _decode_floats(buf, mode_offsets[rows] + 4, value_count).tobytes()
+        row_size = value_count * 4
+        start = 0
+        for row in rows.tolist():
+            row_values = array('f')
+            row_values.frombytes(values[start:start + row_size])
+            color_values[row] = row_values
+            start += row_size
+
+    return tuple(column.tolist() for column in columns) + (color_values,)